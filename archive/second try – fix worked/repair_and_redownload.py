@@ -8,12 +8,17 @@ Repair downloader:
 """
 
 import os
-import re
-import time
+import sys
 import json
+import asyncio
+import tempfile
+import aiohttp
 import pandas as pd
-import requests
-from typing import List, Tuple, Dict
+from pathlib import Path
+from typing import List, Tuple, Dict, BinaryIO
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))  # shared helpers at repo root
+from trials_common import extract_pairs, normalize_nct, normalize_nct_series, parse_ris, safe
 
 # ============== CONFIG ==============
 DOWNLOAD_DIR = "/Users/sg/Desktop/nih/informed consent/downloads"
@@ -21,10 +26,13 @@ CSV_FILE     = "ctg-studies (informed consent).csv"
 RIS_FILE     = "ctg-studies (informed consent).ris"
 DOCS_COLUMN  = "Study Documents"
 NCT_COLUMN   = "NCT Number"
+CSV_CHUNK_ROWS = 50_000  # rows per read_csv chunk; bounds peak memory
 
 # Networking
-TIMEOUT_SECS = 60
-PAUSE_SECS   = 0.1   # small delay to be polite
+TIMEOUT_SECS = 60    # per connect / per read, not for the whole transfer
+PER_HOST     = 8     # open connections per host, to stay polite; also the
+                     # number of downloads in flight (nearly all share one CDN)
+CHUNK_BYTES  = 64 * 1024  # streamed write size
 HEADERS = {
     # a vanilla UA helps avoid some CDNs rejecting requests
     "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
@@ -36,119 +44,73 @@ MAX_NAME = 80
 # ====================================
 
 
-def normalize_nct(x: str) -> str:
-    """Convert variations like 'nct4019' or 'NCT125' -> 'NCT00004019' / 'NCT00000125'."""
-    s = str(x).strip().upper()
-    s = s.replace(" ", "")
-    s = s.replace("NCT", "")
-    s = re.sub(r"\D", "", s)  # keep digits
-    return "NCT" + s.zfill(8)
-
-
-def safe(name: str) -> str:
-    cleaned = re.sub(r"[^a-zA-Z0-9._-]+", "_", name.strip())
-    return cleaned[:MAX_NAME].strip("._-")
-
-
 def find_empty_folders(root: str) -> List[str]:
     """Return normalized NCT IDs for any *existing* subfolders with zero files."""
     empties = []
     if not os.path.isdir(root):
         print(f"[WARN] Download root not found: {root}")
         return empties
-    for entry in os.listdir(root):
-        path = os.path.join(root, entry)
-        if not os.path.isdir(path):
-            continue
-        # consider files only (ignore subdirs just in case)
-        files = [f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f))]
-        if len(files) == 0:
-            # normalize the folder name to a canonical NCT just in case
-            empties.append(normalize_nct(entry))
+    # scandir's DirEntry answers is_dir/is_file from the readdir data,
+    # so this costs no extra stat() per entry
+    with os.scandir(root) as outer:
+        for entry in outer:
+            if not entry.is_dir():
+                continue
+            # consider files only (ignore subdirs just in case); stop at the first
+            with os.scandir(entry.path) as inner:
+                empty = not any(f.is_file() for f in inner)
+            if empty:
+                # normalize the folder name to a canonical NCT just in case
+                empties.append(normalize_nct(entry.name))
     return sorted(set(empties))
 
 
-def parse_ris(path: str) -> Dict[str, Dict[str, str]]:
-    """Very light RIS parser keyed by normalized NCT ID -> {author, year, title}."""
-    if not os.path.exists(path):
-        print(f"[WARN] RIS not found: {path} (filenames will default to NA)")
-        return {}
-    meta = {}
-    with open(path, encoding="utf-8", errors="ignore") as fh:
-        rec = {}
-        for ln in fh:
-            tag = ln[:2].strip()
-            val = ln[6:].strip()
-            if not tag:
-                continue
-            if tag == "TY" and rec:  # new record
-                if "ID" in rec:
-                    nid = normalize_nct(rec["ID"])
-                    meta[nid] = {
-                        "author": rec.get("AU", "").split(",")[0],
-                        "year": rec.get("PY", ""),
-                        "title": rec.get("TI", ""),
-                    }
-                rec = {}
-            rec[tag] = val
-        # last
-        if "ID" in rec:
-            nid = normalize_nct(rec["ID"])
-            meta[nid] = {
-                "author": rec.get("AU", "").split(",")[0],
-                "year": rec.get("PY", ""),
-                "title": rec.get("TI", ""),
-            }
-    return meta
-
-
-def extract_pairs(cell: str) -> List[Tuple[str, str]]:
-    """
-    Robustly extract (doc_type, url) from a Study Documents cell.
-    Handles:
-      - "X, https://...pdf" (canonical)
-      - "X | https://...pdf"
-      - "... Prot_SAP_ICF_000.pdf" (combined)
-      - extra commas in descriptors
-    Strategy:
-      - split by pipe to get chunks
-      - for each chunk, find *all* PDF URLs via regex
-      - doc_type = chunk text before URL occurrence (fallback 'Document')
-    """
-    results: List[Tuple[str, str]] = []
-    if not cell or str(cell).strip().lower() in ("nan", "none"):
-        return results
-
-    chunks = [c.strip() for c in str(cell).split("|") if c.strip()]
-    url_re = re.compile(r"(https?://[^\s,|]+?\.pdf)(?!\S)", re.IGNORECASE)
-
-    for ch in chunks:
-        # find all pdf links in chunk
-        urls = url_re.findall(ch)
-        if urls:
-            # for each url, take the prefix text as doc type if present
-            for u in urls:
-                prefix = ch.split(u, 1)[0].strip().strip(",")
-                doc_type = prefix if prefix else "Document"
-                results.append((doc_type, u.strip()))
-        else:
-            # fallback: try simple "label, url" split
-            if "," in ch:
-                typ, url = ch.split(",", 1)
-                if url.strip().lower().startswith("http"):
-                    results.append((typ.strip(), url.strip()))
-    return results
+def open_part(outpath: str) -> Tuple[BinaryIO, str]:
+    """Open a unique .part file beside outpath; returns (file, path)."""
+    fd, part = tempfile.mkstemp(dir=os.path.dirname(outpath), suffix=".part")
+    os.chmod(part, 0o644)  # mkstemp creates 0600
+    return os.fdopen(fd, "wb"), part
 
 
-def download(url: str, outpath: str) -> Tuple[bool, str]:
+async def download(session: aiohttp.ClientSession, sem: asyncio.Semaphore,
+                   url: str, outpath: str) -> Tuple[bool, str]:
+    # stream into a unique .part file so big PDFs never sit in RAM whole, and a
+    # failed transfer can't leave a half file that hides the folder next run
+    part = None
     try:
-        r = requests.get(url, timeout=TIMEOUT_SECS, headers=HEADERS)
-        r.raise_for_status()
-        with open(outpath, "wb") as fh:
-            fh.write(r.content)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=TIMEOUT_SECS,
+                                        sock_read=TIMEOUT_SECS)
+        async with sem, session.get(url, timeout=timeout) as r:
+            r.raise_for_status()
+            # local file I/O is blocking (often a slow network drive); keep it
+            # off the event loop so one slow write doesn't stall every transfer
+            fh, part = await asyncio.to_thread(open_part, outpath)
+            try:
+                async for chunk in r.content.iter_chunked(CHUNK_BYTES):
+                    await asyncio.to_thread(fh.write, chunk)
+            finally:
+                await asyncio.to_thread(fh.close)
+        await asyncio.to_thread(os.replace, part, outpath)
         return True, ""
     except Exception as e:
-        return False, str(e)
+        if part:
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+        return False, f"{type(e).__name__}: {e}"  # timeouts have an empty str()
+
+
+async def download_all(jobs: List[Tuple[str, str, str]]) -> List[Tuple[bool, str]]:
+    """Fetch every (nct, url, outpath) job concurrently; results keep job order."""
+    # no more in flight than the connector can serve, so nothing idles in its queue
+    sem = asyncio.Semaphore(PER_HOST)
+    connector = aiohttp.TCPConnector(limit_per_host=PER_HOST)
+    async with aiohttp.ClientSession(headers=HEADERS, connector=connector) as session:
+        tasks = [download(session, sem, url, fpath) for _, url, fpath in jobs]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    return [(False, f"{type(r).__name__}: {r}") if isinstance(r, BaseException) else r
+            for r in results]
 
 
 def main():
@@ -170,64 +132,79 @@ def main():
 
     # Load RIS (for filenames)
     print("[2] Loading RIS metadata…")
+    if not os.path.exists(RIS_FILE):
+        print(f"[WARN] RIS not found: {RIS_FILE} (filenames will default to NA)")
     ris = parse_ris(RIS_FILE)
     print(f"    → metadata for {len(ris)} trials")
 
     # Load CSV
     print("[3] Loading CSV…")
-    df = pd.read_csv(CSV_FILE)
-    # Build row map by normalized NCT
-    rows_by_nct: Dict[str, Dict] = {}
-    for _, row in df.iterrows():
-        nct = normalize_nct(row.get(NCT_COLUMN, ""))
-        rows_by_nct[nct] = row
+    # Stream the two columns we read and keep only target NCTs' docs cells
+    # (last row wins on duplicates), so peak memory is one chunk
+    rows_by_nct: Dict[str, str] = {}
+    chunks = pd.read_csv(CSV_FILE, usecols=[NCT_COLUMN, DOCS_COLUMN], chunksize=CSV_CHUNK_ROWS)
+    for chunk in chunks:
+        chunk["_nct"] = normalize_nct_series(chunk[NCT_COLUMN])
+        hit = chunk[chunk["_nct"].isin(merged)]
+        # plain NCT -> str dict; later rows overwrite earlier ones
+        rows_by_nct.update(zip(hit["_nct"], hit[DOCS_COLUMN].fillna("").astype(str)))
 
     # Iterate missing NCTs that exist in the CSV
-    print("[4] Starting selective re-download…")
+    print("[4] Collecting documents to re-download…")
     success_count = 0
     fail_count = 0
     skipped_missing_in_csv = 0
     errors = []
+    jobs: List[Tuple[str, str, str]] = []  # (nct, url, outpath)
 
     for nct in sorted(merged):
         if nct not in rows_by_nct:
             skipped_missing_in_csv += 1
             continue
 
-        row = rows_by_nct[nct]
-        docs_cell = str(row.get(DOCS_COLUMN, "") or "")
-        pairs = extract_pairs(docs_cell)
+        pairs = extract_pairs(rows_by_nct[nct])
         if not pairs:
             print(f"[{nct}] no parsable docs in CSV row; skipping")
             continue
 
         # RIS metadata for naming
         meta = ris.get(nct, {})
-        author = safe(meta.get("author", "") or "NA")
-        year   = safe(meta.get("year", "") or "NA")
-        title  = safe(meta.get("title", "") or "NA")
+        first_au = (meta.get("authors") or [""])[0].split(",")[0]
+        author = safe(first_au or "NA", MAX_NAME)
+        year   = safe(meta.get("year", "") or "NA", MAX_NAME)
+        title  = safe(meta.get("title", "") or "NA", MAX_NAME)
 
         # Ensure folder exists and is still empty (or at least writable)
         folder = os.path.join(DOWNLOAD_DIR, nct)
         os.makedirs(folder, exist_ok=True)
 
         print(f"[{nct}] retrying {len(pairs)} doc(s)")
+        # names truncate and often carry NA parts, so distinct docs can share
+        # one; number the extras so no two downloads target the same file
+        queued: Dict[str, str] = {}  # fname -> url
         for doc_type, url in pairs:
             if not url.lower().startswith("http"):
                 continue
-            fname = f"{author}{year}_{safe(doc_type)}_{title}.pdf"
-            fpath = os.path.join(folder, fname)
-
-            ok, err = download(url, fpath)
-            if ok:
-                print(f"   ✔ {os.path.basename(fpath)}")
-                success_count += 1
-            else:
-                print(f"   ✘ {url} – {err}")
-                errors.append({"nct": nct, "url": url, "error": err})
-                fail_count += 1
-
-            time.sleep(PAUSE_SECS)
+            fname = f"{author}{year}_{safe(doc_type, MAX_NAME)}_{title}.pdf"
+            base, n = fname[:-4], 1
+            while queued.get(fname, url) != url:
+                n += 1
+                fname = f"{base}_{n}.pdf"
+            if fname in queued:
+                continue  # same URL listed twice
+            queued[fname] = url
+            jobs.append((nct, url, os.path.join(folder, fname)))
+
+    print(f"[5] Downloading {len(jobs)} file(s), {PER_HOST} at a time…")
+    results = asyncio.run(download_all(jobs))
+    for (nct, url, fpath), (ok, err) in zip(jobs, results):
+        if ok:
+            print(f"   ✔ {nct} {os.path.basename(fpath)}")
+            success_count += 1
+        else:
+            print(f"   ✘ {nct} {url} – {err}")
+            errors.append({"nct": nct, "url": url, "error": err})
+            fail_count += 1
 
     print("\n[Summary]")
     print(f"  Downloads OK : {success_count}")
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
-import os, re, json, shutil
+import os, json, gzip, hashlib, argparse
 import pandas as pd
+import jinja2
 from pathlib import Path
 from html import escape
 from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from trials_common import dump_json, extract_pairs, normalize_nct_series, parse_ris
 
 # ===== CONFIG =====
 CSV_FILE = "ctg-studies (informed consent).csv"
@@ -13,92 +16,138 @@ TITLE = "Informed Consent – Trials Explorer"
 # ==================
 
 PDFJS_VIEWER = "https://mozilla.github.io/pdf.js/web/viewer.html?file="
+CSV_COLUMNS = ["NCT Number", "Study Documents", "Study Title", "Study URL"]
+WRITE_WORKERS = (os.cpu_count() or 1) * 2   # threads for per-study page writes
+MANIFEST = "_manifest.json"   # {index, studies: {nct: hash}} from the last build
 
-def normalize_nct(x: str) -> str:
-    s = str(x).strip().upper().replace(" ", "").replace("NCT", "")
-    s = re.sub(r"\D", "", s)
-    return "NCT" + s.zfill(8)
+# Per-study page (CSV docs + multi-PDF previews). Compiled once; autoescape
+# covers every interpolated field, so nothing is escaped by hand.
+JINJA = jinja2.Environment(autoescape=True, auto_reload=False,
+                           trim_blocks=True, lstrip_blocks=True)
+STUDY_TMPL = JINJA.from_string("""<!doctype html>
+<html lang="en"><head>
+<meta charset="utf-8"/><meta name="viewport" content="width=device-width,initial-scale=1"/>
+<title>{{ nct }} – {{ title }}</title>
+<link rel="stylesheet" href="../assets/styles.css"/>
+</head><body><div class="container">
+  <a href="../index.html">← Back to index</a>
+  <h1>{{ nct }}</h1>
 
-def parse_ris(path: str):
-    meta = {}
-    if not os.path.exists(path): return meta
-    rec = {}
-    with open(path, encoding="utf-8", errors="ignore") as fh:
-        for ln in fh:
-            tag = ln[:2].strip()
-            val = ln[6:].strip()
-            if not tag:
-                continue
-            if tag == "TY" and rec:
-                if "ID" in rec:
-                    nid = normalize_nct(rec["ID"])
-                    meta[nid] = {
-                        "title": rec.get("TI",""),
-                        "year":  rec.get("PY",""),
-                        "authors": [rec.get("AU","")] if rec.get("AU") else []
-                    }
-                rec = {}
-            rec[tag] = val
-        if "ID" in rec:
-            nid = normalize_nct(rec["ID"])
-            meta[nid] = {
-                "title": rec.get("TI",""),
-                "year":  rec.get("PY",""),
-                "authors": [rec.get("AU","")] if rec.get("AU") else []
-            }
-    return meta
+  <div class="card">
+    <div><strong>Title:</strong> {{ title }}</div>
+    <div class="meta"><strong>Year:</strong> {{ year }} &nbsp; <strong>Authors:</strong> {{ authors }}</div>
+    <div class="meta">{% if registry_url %}<a href="{{ registry_url }}" target="_blank" rel="noopener">Registry page</a>{% endif %}</div>
+  </div>
+
+  <div class="card">
+    <h3>Study Documents</h3>
+    <ul class="list">
+    {% for d in docs %}
+      <li>📄 <a href="{{ d.url }}" target="_blank" rel="noopener">{{ d.label }}</a></li>
+    {% else %}
+      <li>No CSV-linked docs.</li>
+    {% endfor %}
+    </ul>
+  </div>
 
-def extract_pairs(cell: str):
-    """
-    Pull (label, url) pairs from CSV 'Study Documents' text.
-    Handles 'label, https://...pdf' and '|'-separated lists.
-    """
-    out = []
-    if not cell or str(cell).strip().lower() in ("nan","none"):
-        return out
-    parts = [p.strip() for p in str(cell).split("|") if p.strip()]
-    url_re = re.compile(r"(https?://[^\s,|]+?\.pdf)(?!\S)", re.I)
+  <div class="card">
+    <h3>Preview</h3>
+{% if docs %}
+    <div class="small" style="margin-bottom:8px;">Jump to: {% for d in docs %}<a class="badge" href="#doc{{ loop.index }}">{{ loop.index }}</a>{{ " " if not loop.last }}{% endfor %}</div>
+  {% for d in docs %}
+    <div id="doc{{ loop.index }}" style="margin:16px 0;">
+      <div class="meta"><strong>Document {{ loop.index }} of {{ loop.length }} — {{ d.name }}</strong></div>
+      <div class="small" style="margin:4px 0 8px 0;">
+        Source: <a href="{{ d.url }}" target="_blank" rel="noopener">{{ d.url }}</a>
+      </div>
+      <iframe class="pdf-iframe"
+              src="{{ viewer }}{{ d.enc }}"
+              loading="lazy"
+              referrerpolicy="no-referrer"
+              title="Preview of {{ d.name }} (Document {{ loop.index }} of {{ loop.length }})"></iframe>
+      <div class="small" style="margin-top:6px;">
+        If the preview is blocked by the source, use the link above to open in a new tab.
+      </div>
+    </div>
+  {% endfor %}
+{% else %}
+    <div class="meta">No document to preview.</div>
+{% endif %}
+  </div>
+</div></body></html>
+""")
+
+def digest(*parts: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
     for p in parts:
-        urls = url_re.findall(p)
-        if urls:
-            for u in urls:
-                label = p.split(u,1)[0].strip().strip(",")
-                out.append((label or "Document", u))
-        else:
-            if "," in p:
-                lab, rest = p.split(",",1)
-                if rest.strip().lower().startswith("http"):
-                    out.append((lab.strip() or "Document", rest.strip()))
-    return out
+        h.update(p.encode("utf-8"))
+    return h.hexdigest()
+
+def write_atomic(path: Path, data) -> None:
+    """Write a temp sibling, then os.replace() it in: readers never see a partial file."""
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_bytes(data.encode("utf-8") if isinstance(data, str) else data)
+    os.replace(tmp, path)
 
-def main():
+def load_manifest(path: Path) -> dict:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+def doc_label(d, idx):
+    """CSV label, else the PDF's filename, else 'Document N'."""
+    lbl = (d.get("label") or "").strip()
+    return lbl or os.path.basename(d.get("url") or "") or f"Document {idx}"
+
+def main(pretty: bool = False):
     # Load CSV + RIS
-    df = pd.read_csv(CSV_FILE)
+    # only the columns the site uses; the other ~26 are never materialized
+    df = pd.read_csv(CSV_FILE, usecols=CSV_COLUMNS)
+    df["_nct"] = normalize_nct_series(df["NCT Number"])
     ris = parse_ris(RIS_FILE)
 
     # Build per-study records from CSV
     studies = []
-    for _, r in df.iterrows():
-        nct = normalize_nct(r.get("NCT Number",""))
-        csv_docs = extract_pairs(r.get("Study Documents",""))
+    cols = ["_nct", "Study Documents", "Study Title", "Study URL"]
+    for nct, docs, study_title, study_url in df[cols].itertuples(index=False, name=None):
+        csv_docs = extract_pairs(docs)
         studies.append({
             "nct": nct,
-            "title": ris.get(nct, {}).get("title") or r.get("Study Title", ""),
+            "title": ris.get(nct, {}).get("title") or study_title,
             "year":  ris.get(nct, {}).get("year", ""),
             "authors": ris.get(nct, {}).get("authors", []),
-            "registry_url": r.get("Study URL", ""),
+            "registry_url": study_url,
             "csv_docs": [{"label": d[0], "url": d[1]} for d in csv_docs],
         })
 
-    # Ensure site structure (fresh build)
+    # Ensure site structure (incremental: pages whose inputs are unchanged are kept)
     site = Path(SITE_DIR)
-    if site.exists():
-        shutil.rmtree(site)
     (site / "studies").mkdir(parents=True, exist_ok=True)
     (site / "assets").mkdir(parents=True, exist_ok=True)
     # nojekyll so GH Pages serves assets as-is
     (site / ".nojekyll").write_text("", encoding="utf-8")
 
+    # Hash every study's inputs; the builder's own source is mixed in so a
+    # template change invalidates every page. Last row per NCT wins, as on disk.
+    manifest_path = site / "assets" / MANIFEST
+    prev = load_manifest(manifest_path)
+    salt = digest(Path(__file__).read_text(encoding="utf-8"))
+    study_keys = [digest(salt, json.dumps(s, sort_keys=True)) for s in studies]
+    keys = {s["nct"]: k for s, k in zip(studies, study_keys)}
+    pages = {s["nct"]: s for s in studies}
+    index_key = digest("pretty" if pretty else "", *study_keys)
+
+    # Drop pages for studies that left the CSV (and temp files from a killed build)
+    removed = 0
+    with os.scandir(site / "studies") as it:
+        for e in it:
+            if e.name.endswith(".tmp"):
+                os.unlink(e.path)
+            elif e.name.endswith(".html") and e.name[:-5] not in keys:
+                os.unlink(e.path)
+                removed += 1
+
     # Client-side search index
     index = [{
         "nct": s["nct"],
@@ -108,13 +157,17 @@ def main():
         "registry_url": s["registry_url"],
         "doc_count": len(s["csv_docs"]),
     } for s in studies]
-    (site / "assets" / "studies.json").write_text(
-        json.dumps(index, ensure_ascii=False, indent=2),
-        encoding="utf-8"
-    )
+    # plus a gzip copy the page inflates itself (Pages won't set Content-Encoding
+    # for it); mtime=0 keeps the bytes identical across rebuilds
+    index_path = site / "assets" / "studies.json"
+    gz_path = site / "assets" / "studies.json.gz"
+    if prev.get("index") != index_key or not index_path.exists() or not gz_path.exists():
+        data = dump_json(index, pretty=pretty)
+        write_atomic(index_path, data)
+        write_atomic(gz_path, gzip.compress(data, compresslevel=9, mtime=0))
 
     # Styles
-    (site / "assets" / "styles.css").write_text("""
+    write_atomic(site / "assets" / "styles.css", """
 :root{--bg:#0b1020;--fg:#e7ecff;--card:#121833;--muted:#9fb0ff;}
 *{box-sizing:border-box}body{margin:0;font-family:ui-sans-serif,system-ui,Segoe UI,Roboto;color:var(--fg);background:linear-gradient(180deg,#0b1020,#0f1733);}
 a{color:#a5c3ff;text-decoration:none}a:hover{text-decoration:underline}
@@ -129,10 +182,10 @@ input[type=search]{width:100%;padding:12px 14px;border-radius:12px;border:1px so
 .list li{margin:6px 0}
 .small{font-size:12px;color:#9fb0ff}
 .meta strong{font-size:15px;color:#cfe0ff}
-""", encoding="utf-8")
+""")
 
     # Index page with Fuse.js search
-    (site / "index.html").write_text(f"""<!doctype html>
+    write_atomic(site / "index.html", f"""<!doctype html>
 <html lang="en"><head>
 <meta charset="utf-8"/><meta name="viewport" content="width=device-width,initial-scale=1"/>
 <title>{escape(TITLE)}</title>
@@ -158,8 +211,18 @@ const card=(r)=> `
     </div>
   </div>`;
 let DATA=[];
+async function loadIndex(){{
+  // ~5-10x smaller over the wire; plain JSON if the stream API or .gz is missing
+  if('DecompressionStream' in window){{
+    try{{
+      const r=await fetch('assets/studies.json.gz');
+      if(r.ok) return await new Response(r.body.pipeThrough(new DecompressionStream('gzip'))).json();
+    }}catch(e){{}}
+  }}
+  return (await fetch('assets/studies.json')).json();
+}}
 async function init(){{
-  DATA = await (await fetch('assets/studies.json')).json();
+  DATA = await loadIndex();
   render(DATA);
   const fuse = new Fuse(DATA, {{
     keys:['nct','title','authors','year'],
@@ -179,112 +242,42 @@ function render(items){{
 init();
 </script>
 </body></html>
-""", encoding="utf-8")
+""")
 
-    # Per-study pages (CSV docs + multi-PDF previews)
-    tmpl = """<!doctype html>
-<html lang="en"><head>
-<meta charset="utf-8"/><meta name="viewport" content="width=device-width,initial-scale=1"/>
-<title>{ptitle}</title>
-<link rel="stylesheet" href="../assets/styles.css"/>
-</head><body><div class="container">
-  <a href="../index.html">← Back to index</a>
-  <h1>{nct}</h1>
-
-  <div class="card">
-    <div><strong>Title:</strong> {title}</div>
-    <div class="meta"><strong>Year:</strong> {year} &nbsp; <strong>Authors:</strong> {authors}</div>
-    <div class="meta">{reglink}</div>
-  </div>
-
-  <div class="card">
-    <h3>Study Documents</h3>
-    <ul class="list">
-      {csv_docs}
-    </ul>
-  </div>
-
-  <div class="card">
-    <h3>Preview</h3>
-    {preview}
-  </div>
-</div></body></html>
-"""
-    for s in studies:
-        nct = s["nct"]
-        title = escape(s["title"] or "(untitled)")
-        ptitle = f"{nct} – {title}"
-        year = escape(s["year"] or "")
-        authors = escape(", ".join([a for a in s["authors"] if a]) or "—")
-        reglink = f'<a href="{escape(s["registry_url"])}" target="_blank" rel="noopener">Registry page</a>' if s["registry_url"] else ""
-
-        # CSV-doc links (external URLs)
-        csv_items = []
-        for d in s["csv_docs"]:
-            lab = escape(d.get("label") or "Document")
-            url = escape(d.get("url") or "")
-            csv_items.append(f'<li>📄 <a href="{url}" target="_blank" rel="noopener">{lab}</a></li>')
-        csv_html = "\n".join(csv_items) if csv_items else "<li>No CSV-linked docs.</li>"
-
-        # Build ALL previews with numbered headers + jump nav
-        if s["csv_docs"]:
-            total = len(s["csv_docs"])
-            nav = []
-            blocks = []
-
-            def label_for(d, idx):
-                lbl = (d.get("label") or "").strip()
-                if not lbl:
-                    try:
-                        fname = os.path.basename(d.get("url") or "")
-                        return fname or f"Document {idx}"
-                    except Exception:
-                        return f"Document {idx}"
-                return lbl
-
-            for idx, d in enumerate(s["csv_docs"], start=1):
-                label = escape(label_for(d, idx))
-                raw_url = d.get("url") or ""
-                enc = quote(raw_url, safe="")
-                anchor = f"doc{idx}"
-
-                nav.append(f'<a class="badge" href="#{anchor}">{idx}</a>')
-                blocks.append(f"""
-                <div id="{anchor}" style="margin:16px 0;">
-                  <div class="meta"><strong>Document {idx} of {total} — {label}</strong></div>
-                  <div class="small" style="margin:4px 0 8px 0;">
-                    Source: <a href="{escape(raw_url)}" target="_blank" rel="noopener">{escape(raw_url)}</a>
-                  </div>
-                  <iframe class="pdf-iframe"
-                          src="{PDFJS_VIEWER}{enc}"
-                          loading="lazy"
-                          referrerpolicy="no-referrer"
-                          title="Preview of {label} (Document {idx} of {total})"></iframe>
-                  <div class="small" style="margin-top:6px;">
-                    If the preview is blocked by the source, use the link above to open in a new tab.
-                  </div>
-                </div>
-                """)
-
-            preview_html = (
-                f'<div class="small" style="margin-bottom:8px;">Jump to: {" ".join(nav)}</div>'
-                + "\n".join(blocks)
+    prev_pages = prev.get("studies", {})
+    # Page writes are independent; hand each to a thread as soon as it's rendered
+    writes = []
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+        for s in pages.values():
+            nct = s["nct"]
+            out = site / "studies" / f"{nct}.html"
+            if prev_pages.get(nct) == keys[nct] and out.exists():
+                continue
+            docs = [{
+                "label": d.get("label") or "Document",
+                "name": doc_label(d, idx),
+                "url": d.get("url") or "",
+                "enc": quote(d.get("url") or "", safe=""),
+            } for idx, d in enumerate(s["csv_docs"], start=1)]
+            html = STUDY_TMPL.render(
+                nct=nct,
+                title=s["title"] or "(untitled)",
+                year=s["year"] or "",
+                authors=", ".join([a for a in s["authors"] if a]) or "—",
+                registry_url=s["registry_url"],
+                docs=docs,
+                viewer=PDFJS_VIEWER,
             )
-        else:
-            preview_html = '<div class="meta">No document to preview.</div>'
-
-        (Path(SITE_DIR)/"studies"/f"{nct}.html").write_text(
-            tmpl.format(
-                ptitle=ptitle, nct=escape(nct),
-                title=title, year=year, authors=authors,
-                reglink=reglink,
-                csv_docs=csv_html,
-                preview=preview_html
-            ),
-            encoding="utf-8"
-        )
+            writes.append(pool.submit(write_atomic, out, html))
+    for w in writes:
+        w.result()  # re-raise any failed write before the manifest records it
 
-    print(f"Built static site → {SITE_DIR}/")
+    # Manifest goes last so an interrupted build redoes its pages next time
+    write_atomic(manifest_path, json.dumps({"index": index_key, "studies": keys}))
+    print(f"Built static site → {SITE_DIR}/ "
+          f"({len(writes)} page(s) written, {len(pages) - len(writes)} unchanged, {removed} removed)")
 
 if __name__ == "__main__":
-    main()
+    ap = argparse.ArgumentParser(description="Build the static site from the CSV + RIS exports.")
+    ap.add_argument("--pretty", action="store_true", help="indent studies.json (debugging)")
+    main(**vars(ap.parse_args()))
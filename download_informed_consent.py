@@ -2,8 +2,13 @@
 
 import os
 import re
+import shutil
 import requests
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # === CONFIG ===
 CSV_FILE = "ctg-studies (informed consent).csv"
@@ -12,11 +17,28 @@ DOCS_COLUMN = "Study Documents"
 NCT_COLUMN = "NCT Number"
 MAX_TITLE_LEN = 50    # truncate title to avoid excessively long filenames
 DOWNLOAD_DIR = "downloads"
+TIMEOUT_SECS = 60
+CHUNK_BYTES = 64 * 1024
+MAX_WORKERS = 16      # parallel downloads; threads share SESSION's pool
+
+# === HTTP ===
+# one pooled session so the handful of CT.gov/NIH hosts keep connections alive
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
 
 # === UTILS ===
+_UNSAFE = re.compile(r'[^a-zA-Z0-9_-]+')
+
+@lru_cache(maxsize=None)  # doc-type labels and NA repeat across thousands of jobs
 def safe(s):
     """Clean string so it's safe for filenames."""
-    return re.sub(r'[^a-zA-Z0-9_-]+', '_', s)[:MAX_TITLE_LEN]
+    return _UNSAFE.sub('_', s)[:MAX_TITLE_LEN]
 
 def parse_ris(path):
     """Parse RIS and return dict keyed by NCT number containing (author, year, title)."""
@@ -50,14 +72,25 @@ def parse_ris(path):
     return meta
 
 def download_file(url, outpath):
+    # a failed transfer must not leave a truncated PDF behind: that would make
+    # the folder non-empty and hide it from the repair script's retry pass
+    part = outpath + '.part'
     try:
-        r = requests.get(url, timeout=60)
-        r.raise_for_status()
-        with open(outpath, 'wb') as fh:
-            fh.write(r.content)
+        with SESSION.get(url, timeout=TIMEOUT_SECS, stream=True) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            with open(part, 'wb') as fh:
+                shutil.copyfileobj(r.raw, fh, length=CHUNK_BYTES)
+        os.replace(part, outpath)
         print(f"✔ downloaded {outpath}")
+        return True
     except Exception as e:
+        try:
+            os.remove(part)
+        except OSError:
+            pass
         print(f"✘ FAILED {url} → {e}")
+        return False
 
 def main():
     os.makedirs(DOWNLOAD_DIR, exist_ok=True)
@@ -69,6 +102,7 @@ def main():
     print("[2] loading CSV...")
     df = pd.read_csv(CSV_FILE)
 
+    by_path = {}  # outpath -> distinct urls, in CSV order
     for idx, row in df.iterrows():
         nct = str(row[NCT_COLUMN]).strip()
         doclist = str(row.get(DOCS_COLUMN, "")).split('|')
@@ -97,8 +131,35 @@ def main():
             if not url.lower().startswith("http"):
                 print(f"Skipping malformed url: {url}")
                 continue
-            download_file(url, outpath)
+            urls = by_path.setdefault(outpath, [])
+            if url not in urls:
+                urls.append(url)
+
+    # names truncate to 50 chars and often carry NA parts, so distinct documents
+    # can land on one path; number the extras rather than have two threads
+    # write the same file
+    jobs = []  # (url, outpath)
+    taken = set(by_path)
+    for outpath, urls in by_path.items():
+        jobs.append((urls[0], outpath))
+        n = 1
+        for url in urls[1:]:
+            alt = outpath
+            while alt in taken:
+                n += 1
+                alt = f"{outpath[:-4]}_{n}.pdf"
+            taken.add(alt)
+            jobs.append((url, alt))
+
+    print(f"[3] downloading {len(jobs)} files with {MAX_WORKERS} workers...")
+    ok = 0
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        futures = [ex.submit(download_file, url, outpath) for url, outpath in jobs]
+        for fut in as_completed(futures):
+            ok += fut.result()
+    print(f"   → {ok}/{len(jobs)} downloaded")
 
+    SESSION.close()
     print("DONE.")
 
 if __name__ == "__main__":
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
-import os, re, json, shutil
+import os, sys, shutil, argparse
 import pandas as pd
 from pathlib import Path
 from html import escape
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # shared helpers at repo root
+from trials_common import dump_json, extract_pairs, normalize_nct, normalize_nct_series, parse_ris
 
 # ====== CONFIG ======
 DOWNLOAD_DIR = "/Users/sg/Desktop/nih/informed consent/downloads"  # your folders
@@ -11,87 +16,133 @@ RIS_FILE     = "ctg-studies (informed consent).ris"
 SITE_DIR     = "site"
 COPY_PDFS    = True   # True = copy PDFs into site/ (big!). False = keep file:// links to your local PDFs OR link to original URLs if present
 OPEN_IN_BROWSER = False
+CSV_COLUMNS  = ["NCT Number", "Study Documents", "Study Title", "Study URL"]  # all we read of ~30
+RENDER_WORKERS = os.cpu_count() or 1  # processes rendering study pages; 1 = render inline
+COPY_WORKERS = 16     # threads copying PDFs (I/O bound)
 # ====================
 
-def normalize_nct(x: str) -> str:
-    x = str(x).strip().upper().replace("NCT","")
-    x = re.sub(r"\D", "", x)
-    return "NCT" + x.zfill(8)
+# per-study page; filled by render_study()
+STUDY_TMPL = """<!doctype html>
+<html lang="en"><head>
+<meta charset="utf-8"/><meta name="viewport" content="width=device-width,initial-scale=1"/>
+<title>{title}</title>
+<link rel="stylesheet" href="../assets/styles.css"/>
+</head><body><div class="container">
+  <a href="../index.html">← Back to index</a>
+  <h1>{nct}</h1>
+  <div class="card">
+    <div><strong>Title:</strong> {title}</div>
+    <div class="meta"><strong>Year:</strong> {year} &nbsp; <strong>Authors:</strong> {authors}</div>
+    <div class="meta">{reglink}</div>
+  </div>
 
-def safe(s: str, maxlen=120) -> str:
-    return re.sub(r"[^a-zA-Z0-9._ -]", "_", (s or "")).strip()[:maxlen]
+  <div class="card">
+    <h3>Documents (from CSV)</h3>
+    <ul class="list">
+      {csv_docs}
+    </ul>
+  </div>
 
-def parse_ris(path: str):
-    meta = {}
-    if not os.path.exists(path): return meta
-    rec = {}
-    with open(path, encoding="utf-8", errors="ignore") as fh:
-        for ln in fh:
-            tag, val = ln[:2].strip(), ln[6:].strip()
-            if not tag: continue
-            if tag == "TY" and rec:
-                if "ID" in rec:
-                    nid = normalize_nct(rec["ID"])
-                    meta[nid] = {
-                        "title": rec.get("TI",""),
-                        "year":  rec.get("PY",""),
-                        "authors": [rec.get("AU","")] if rec.get("AU") else []
-                    }
-                rec = {}
-            rec[tag] = val
-        if "ID" in rec:
-            nid = normalize_nct(rec["ID"])
-            meta[nid] = {
-                "title": rec.get("TI",""),
-                "year":  rec.get("PY",""),
-                "authors": [rec.get("AU","")] if rec.get("AU") else []
-            }
-    return meta
+  <div class="card">
+    <h3>Local PDFs</h3>
+    <ul class="list">
+      {local_list}
+    </ul>
+    {preview}
+  </div>
 
-def extract_pairs(cell: str):
-    """
-    Pull (doc_type, url) pairs from CSV 'Study Documents' text.
-    Handles 'label, https://...pdf' and '... | https://...pdf' etc.
-    """
-    out = []
-    if not cell or str(cell).strip().lower() in ("nan","none"): return out
-    parts = [p.strip() for p in str(cell).split("|") if p.strip()]
-    url_re = re.compile(r"(https?://[^\s,|]+?\.pdf)(?!\S)", re.I)
-    for p in parts:
-        urls = url_re.findall(p)
-        if urls:
-            for u in urls:
-                label = p.split(u,1)[0].strip().strip(",")
-                out.append((label or "Document", u))
-        else:
-            if "," in p:
-                lab, rest = p.split(",",1)
-                if rest.strip().lower().startswith("http"):
-                    out.append((lab.strip(), rest.strip()))
-    return out
+</div></body></html>
+"""
+
+def render_study(s: dict, copy_pdfs: bool) -> tuple:
+    """(nct, page html) for one study; top-level so a process pool can run it."""
+    nct = s["nct"]
+    title = escape(s["title"] or "(untitled)")
+    year = escape(s["year"] or "")
+    authors = escape(", ".join([a for a in s["authors"] if a]) or "")
+    reglink = f'<a href="{escape(s["registry_url"])}" target="_blank" rel="noopener">Registry page</a>' if s["registry_url"] else ""
+
+    # CSV-doc links (external CDN)
+    csv_items = []
+    for d in s["csv_docs"]:
+        lab = escape(d["label"] or "Document")
+        url = escape(d["url"])
+        csv_items.append(f'<li>📄 <a href="{url}" target="_blank" rel="noopener">{lab}</a></li>')
+    csv_html = "\n".join(csv_items) if csv_items else "<li>No CSV-linked docs.</li>"
 
-def main():
+    # Local PDFs (either copied into site/pdfs/ or linked via file://)
+    local_items, preview_html = [], ""
+    if copy_pdfs:
+        for lp in s["local_pdfs"]:
+            name = escape(Path(lp).name)
+            rel = f"../pdfs/{nct}/{name}"
+            local_items.append(f'<li>📎 <a href="{rel}" target="_blank" rel="noopener">{name}</a></li>')
+        # embed first pdf preview if any
+        if s["local_pdfs"]:
+            first = escape(f"../pdfs/{nct}/{Path(s['local_pdfs'][0]).name}")
+            preview_html = f'<iframe class="pdf-iframe" src="{first}#view=FitH&toolbar=1"></iframe>'
+    else:
+        for lp in s["local_pdfs"]:
+            name = escape(Path(lp).name)
+            # Link to local file path (will work when opened locally; for web hosting, prefer COPY_PDFS=True)
+            local_items.append(f'<li>📎 <a href="file://{escape(lp)}" target="_blank">{name}</a></li>')
+        if s["local_pdfs"]:
+            preview_html = f'<div class="meta">Preview disabled (COPY_PDFS=False). Enable it to embed PDFs on the page.</div>'
+
+    return nct, STUDY_TMPL.format(
+        nct=escape(nct),
+        title=title,
+        year=year,
+        authors=authors or "—",
+        reglink=reglink or "",
+        csv_docs=csv_html,
+        local_list="\n".join(local_items) if local_items else "<li>No local PDFs found.</li>",
+        preview=preview_html
+    )
+
+def sync_pdf(src: Path, dst: Path) -> bool:
+    """Bring dst up to date with src (hardlink, else copy); False if it already was."""
+    st = src.stat()
+    try:
+        dt = dst.stat()
+        if dt.st_size == st.st_size and dt.st_mtime >= st.st_mtime:
+            return False
+        dst.unlink()
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, dst)  # same filesystem: no bytes written at all
+    except OSError:
+        shutil.copy2(src, dst)
+    return True
+
+def main(force: bool = False):
     # load CSV + RIS
-    df = pd.read_csv(CSV_FILE)
+    df = pd.read_csv(CSV_FILE, usecols=CSV_COLUMNS)
     ris = parse_ris(RIS_FILE)
 
-    # build lookup from CSV
+    # build lookup from CSV (NCTs normalized column-wise, then plain tuples)
+    df["_nct"] = normalize_nct_series(df["NCT Number"])
     rows = {}
-    for _, r in df.iterrows():
-        nct = normalize_nct(r.get("NCT Number",""))
+    cols = ["_nct", "Study Title", "Study URL", "Study Documents"]
+    for nct, title, url, docs in df[cols].itertuples(index=False, name=None):
         rows[nct] = {
             "nct": nct,
-            "study_title": r.get("Study Title",""),
-            "study_url": r.get("Study URL",""),
-            "study_docs": extract_pairs(r.get("Study Documents","")),
+            "study_title": title,
+            "study_url": url,
+            "study_docs": extract_pairs(docs),
         }
 
-    # scan local PDFs
-    dl_root = Path(DOWNLOAD_DIR)
+    # scan local PDFs; DirEntry answers is_dir/is_file from readdir, no stat() per entry.
+    # The root is resolved once, so entry paths below are already absolute
+    dl_root = os.path.realpath(DOWNLOAD_DIR)
     studies = []
-    for nct_dir in sorted([p for p in dl_root.iterdir() if p.is_dir() and p.name.upper().startswith("NCT")]):
+    with os.scandir(dl_root) as it:
+        nct_dirs = sorted((e for e in it if e.is_dir() and e.name.upper().startswith("NCT")), key=lambda e: e.name)
+    for nct_dir in nct_dirs:
         nct = normalize_nct(nct_dir.name)
-        pdfs = sorted([p for p in nct_dir.iterdir() if p.is_file() and p.suffix.lower()==".pdf"])
+        with os.scandir(nct_dir.path) as it:
+            pdfs = sorted(e.path for e in it if e.is_file() and e.name.lower().endswith(".pdf"))
         row = rows.get(nct, {"nct": nct, "study_title": "", "study_url": "", "study_docs": []})
         rmeta = ris.get(nct, {"title":"", "year":"", "authors":[]})
 
@@ -102,25 +153,58 @@ def main():
             "authors": rmeta["authors"],
             "registry_url": row["study_url"],
             "csv_docs": [{"label": d[0], "url": d[1]} for d in row["study_docs"]],
-            "local_pdfs": [str(p.resolve()) for p in pdfs],  # absolute paths
+            "local_pdfs": pdfs,  # absolute paths
         })
 
     # ensure site structure
+    # site/pdfs survives between builds (synced below) unless --force
     site = Path(SITE_DIR)
-    if site.exists(): shutil.rmtree(site)
+    if site.exists():
+        if force or not COPY_PDFS:
+            shutil.rmtree(site)
+        else:
+            for p in site.iterdir():
+                if p.name == "pdfs": continue
+                if p.is_dir() and not p.is_symlink(): shutil.rmtree(p)
+                else: p.unlink()
     (site / "studies").mkdir(parents=True, exist_ok=True)
     (site / "assets").mkdir(parents=True, exist_ok=True)
 
     # optional copy PDFs (warning: huge; otherwise we link to file:// or original URL)
     if COPY_PDFS:
         (site / "pdfs").mkdir(parents=True, exist_ok=True)
+        copies = []
         for s in studies:
             tgt = site / "pdfs" / s["nct"]
             tgt.mkdir(parents=True, exist_ok=True)
             for src in s["local_pdfs"]:
                 srcp = Path(src)
                 if not srcp.exists(): continue
-                shutil.copy2(srcp, tgt / srcp.name)
+                copies.append((srcp, tgt / srcp.name))
+        with ThreadPoolExecutor(COPY_WORKERS) as ex:
+            synced = sum(ex.map(lambda job: sync_pdf(*job), copies))  # sum() re-raises copy errors
+        # drop PDFs (and study folders) a fresh build would no longer have
+        wanted = {str(dst) for _, dst in copies}
+        ncts = {s["nct"] for s in studies}
+        with os.scandir(site / "pdfs") as it:
+            for d in it:
+                # follow_symlinks=False: a symlink gets unlinked, never walked or rmtree'd
+                is_dir = d.is_dir(follow_symlinks=False)
+                if not is_dir or d.name not in ncts:
+                    if is_dir:
+                        shutil.rmtree(d.path)
+                    else:
+                        os.unlink(d.path)
+                    continue
+                with os.scandir(d.path) as files:
+                    for f in files:
+                        if f.path in wanted:
+                            continue
+                        if f.is_dir(follow_symlinks=False):
+                            shutil.rmtree(f.path)
+                        else:
+                            os.unlink(f.path)
+        print(f"PDFs: {synced} linked/copied, {len(copies) - synced} unchanged")
 
     # write a JSON index for client-side search
     index = []
@@ -132,7 +216,7 @@ def main():
             "authors": s["authors"],
             "registry_url": s["registry_url"],
         })
-    (site / "assets" / "studies.json").write_text(json.dumps(index, ensure_ascii=False, indent=2), encoding="utf-8")
+    (site / "assets" / "studies.json").write_bytes(dump_json(index, pretty=True))
 
     # simple CSS
     (site / "assets" / "styles.css").write_text("""
@@ -199,85 +283,16 @@ init();
 </body></html>
 """, encoding="utf-8")
 
-    # per-study pages
-    tmpl = """<!doctype html>
-<html lang="en"><head>
-<meta charset="utf-8"/><meta name="viewport" content="width=device-width,initial-scale=1"/>
-<title>{title}</title>
-<link rel="stylesheet" href="../assets/styles.css"/>
-</head><body><div class="container">
-  <a href="../index.html">← Back to index</a>
-  <h1>{nct}</h1>
-  <div class="card">
-    <div><strong>Title:</strong> {title}</div>
-    <div class="meta"><strong>Year:</strong> {year} &nbsp; <strong>Authors:</strong> {authors}</div>
-    <div class="meta">{reglink}</div>
-  </div>
-
-  <div class="card">
-    <h3>Documents (from CSV)</h3>
-    <ul class="list">
-      {csv_docs}
-    </ul>
-  </div>
-
-  <div class="card">
-    <h3>Local PDFs</h3>
-    <ul class="list">
-      {local_list}
-    </ul>
-    {preview}
-  </div>
-
-</div></body></html>
-"""
-    for s in studies:
-        nct = s["nct"]
-        title = escape(s["title"] or "(untitled)")
-        year = escape(s["year"] or "")
-        authors = escape(", ".join([a for a in s["authors"] if a]) or "")
-        reglink = f'<a href="{escape(s["registry_url"])}" target="_blank" rel="noopener">Registry page</a>' if s["registry_url"] else ""
-
-        # CSV-doc links (external CDN)
-        csv_items = []
-        for d in s["csv_docs"]:
-            lab = escape(d["label"] or "Document")
-            url = escape(d["url"])
-            csv_items.append(f'<li>📄 <a href="{url}" target="_blank" rel="noopener">{lab}</a></li>')
-        csv_html = "\n".join(csv_items) if csv_items else "<li>No CSV-linked docs.</li>"
-
-        # Local PDFs (either copied into site/pdfs/ or linked via file://)
-        local_items, preview_html = [], ""
-        if COPY_PDFS:
-            for lp in s["local_pdfs"]:
-                name = escape(Path(lp).name)
-                rel = f"../pdfs/{nct}/{name}"
-                local_items.append(f'<li>📎 <a href="{rel}" target="_blank" rel="noopener">{name}</a></li>')
-            # embed first pdf preview if any
-            if s["local_pdfs"]:
-                first = escape(f"../pdfs/{nct}/{Path(s['local_pdfs'][0]).name}")
-                preview_html = f'<iframe class="pdf-iframe" src="{first}#view=FitH&toolbar=1"></iframe>'
-        else:
-            for lp in s["local_pdfs"]:
-                name = escape(Path(lp).name)
-                # Link to local file path (will work when opened locally; for web hosting, prefer COPY_PDFS=True)
-                local_items.append(f'<li>📎 <a href="file://{escape(lp)}" target="_blank">{name}</a></li>')
-            if s["local_pdfs"]:
-                preview_html = f'<div class="meta">Preview disabled (COPY_PDFS=False). Enable it to embed PDFs on the page.</div>'
-
-        (Path(SITE_DIR)/"studies"/f"{nct}.html").write_text(
-            tmpl.format(
-                nct=escape(nct),
-                title=title,
-                year=year,
-                authors=authors or "—",
-                reglink=reglink or "",
-                csv_docs=csv_html,
-                local_list="\n".join(local_items) if local_items else "<li>No local PDFs found.</li>",
-                preview=preview_html
-            ),
-            encoding="utf-8"
-        )
+    # per-study pages: rendered across cores, written from here
+    studies_dir = Path(SITE_DIR) / "studies"
+    render = partial(render_study, copy_pdfs=COPY_PDFS)
+    if RENDER_WORKERS > 1:
+        with ProcessPoolExecutor(RENDER_WORKERS) as ex:
+            pages = list(ex.map(render, studies, chunksize=64))
+    else:
+        pages = map(render, studies)
+    for nct, html in pages:
+        (studies_dir / f"{nct}.html").write_text(html, encoding="utf-8")
 
     print(f"Built static site → {SITE_DIR}/")
     if OPEN_IN_BROWSER:
@@ -285,4 +300,6 @@ init();
         webbrowser.open(f"file://{Path(SITE_DIR).resolve()}/index.html")
 
 if __name__ == "__main__":
-    main()
+    ap = argparse.ArgumentParser(description="Build the static site from local PDFs + CSV/RIS metadata.")
+    ap.add_argument("--force", action="store_true", help="wipe site/ (including synced PDFs) and rebuild from scratch")
+    main(**vars(ap.parse_args()))
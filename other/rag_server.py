@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
-import os, re, json, math, hashlib, tempfile
-from typing import List, Dict, Optional
+import os, re, sys, json, math, asyncio, hashlib, sqlite3, tempfile, threading
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import pandas as pd
-import pdfplumber
-import requests
+import pypdfium2 as pdfium
+import aiohttp
 import numpy as np
-from openai import OpenAI
+from cachetools import LRUCache
+from openai import AsyncOpenAI
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # shared helpers at repo root
+from trials_common import extract_pairs, normalize_nct, normalize_nct_series, parse_ris
 
 # ==== CONFIG ====
 CSV_FILE     = "ctg-studies (informed consent).csv"
+CSV_COLUMNS  = ["NCT Number", "Study Documents", "Study Title", "Study URL"]  # all we read of ~30
 RIS_FILE     = "ctg-studies (informed consent).ris"
 DOWNLOAD_DIR = "/Users/sg/Desktop/nih/informed consent/downloads"
 EMBED_MODEL  = "text-embedding-3-small"   # cheap + good; switch to -large if you want
@@ -19,136 +26,268 @@ CHAT_MODEL   = "gpt-4o-mini"              # adjust to what you have
 TOP_K        = 8
 CHUNK_TOKENS = 700                        # approx chars; simple splitter below uses chars
 OVERLAP      = 120
+EMBED_BATCH  = 96                         # chunks per embeddings request
+EMBED_CONCURRENCY = 4                     # embeddings requests in flight, to stay under rate limits
+CACHE_DB     = "rag_cache.sqlite3"        # per-PDF chunks + vectors, survives restarts
+PER_HOST     = 4                          # concurrent PDF downloads per host
+RETRIES      = 3                          # same policy as the downloader's urllib3 Retry
+RETRY_STATUS = {502, 503, 504}
+CHUNK_BYTES  = 64 * 1024                  # streamed download / hashing block size
+CACHE_MB     = 512                        # memory budget for built study contexts (LRU)
+HTTP_TIMEOUT = 60                         # per connect / per read, like requests' timeout=
 
 # Expect OPENAI_API_KEY in environment (do NOT put keys in the browser)
-client = OpenAI()
+client = AsyncOpenAI()
+EMBED_SEM = asyncio.Semaphore(EMBED_CONCURRENCY)  # shared by every study's embed() calls
 
 # ==== HELPERS ====
-def normalize_nct(x: str) -> str:
-    s = str(x).strip().upper().replace("NCT", "")
-    s = re.sub(r"\D", "", s)
-    return "NCT" + s.zfill(8)
-
-def load_ris(path: str) -> Dict[str, Dict[str, str]]:
-    meta = {}
-    if not os.path.exists(path): return meta
-    rec = {}
-    with open(path, encoding="utf-8", errors="ignore") as fh:
-        for ln in fh:
-            tag, val = ln[:2].strip(), ln[6:].strip()
-            if not tag: continue
-            if tag == "TY" and rec:
-                if "ID" in rec:
-                    nid = normalize_nct(rec["ID"])
-                    meta[nid] = {
-                        "title": rec.get("TI",""),
-                        "year":  rec.get("PY",""),
-                        "authors": [rec.get("AU","")] if rec.get("AU") else []
-                    }
-                rec = {}
-            rec[tag] = val
-        if "ID" in rec:
-            nid = normalize_nct(rec["ID"])
-            meta[nid] = {
-                "title": rec.get("TI",""),
-                "year":  rec.get("PY",""),
-                "authors": [rec.get("AU","")] if rec.get("AU") else []
-            }
-    return meta
-
-def extract_pairs(cell: str):
-    out = []
-    if not cell or str(cell).strip().lower() in ("nan","none"): return out
-    parts = [p.strip() for p in str(cell).split("|") if p.strip()]
-    url_re = re.compile(r"(https?://[^\s,|]+?\.pdf)(?!\S)", re.I)
-    for p in parts:
-        urls = url_re.findall(p)
-        if urls:
-            for u in urls:
-                label = p.split(u,1)[0].strip().strip(",")
-                out.append((label or "Document", u))
-        else:
-            if "," in p:
-                lab, rest = p.split(",",1)
-                if rest.strip().lower().startswith("http"):
-                    out.append((lab.strip(), rest.strip()))
-    return out
-
 # Load CSV to map NCT -> doc URLs + registry URL
-df = pd.read_csv(CSV_FILE)
+df = pd.read_csv(CSV_FILE, usecols=CSV_COLUMNS)
+df["_nct"] = normalize_nct_series(df["NCT Number"])
 CSV_MAP = {}
-for _, r in df.iterrows():
-    nct = normalize_nct(r.get("NCT Number",""))
+# plain tuples of just the columns we use; iterrows built a Series per row
+cols = ["_nct", "Study URL", "Study Documents", "Study Title"]
+for nct, url, docs, title in df[cols].itertuples(index=False, name=None):
     CSV_MAP[nct] = {
-        "study_url": r.get("Study URL",""),
-        "docs": extract_pairs(r.get("Study Documents","")),
-        "study_title": r.get("Study Title",""),
+        "study_url": url,
+        "docs": extract_pairs(docs),
+        "study_title": title,
     }
 
-RIS_MAP = load_ris(RIS_FILE)
+RIS_MAP = parse_ris(RIS_FILE)
 
 def get_local_pdfs(nct: str) -> List[str]:
     folder = os.path.join(DOWNLOAD_DIR, nct)
     if not os.path.isdir(folder): return []
-    return [os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(".pdf")]
+    with os.scandir(folder) as it:
+        return [e.path for e in it if e.is_file() and e.name.lower().endswith(".pdf")]
+
+HTTP: Optional[aiohttp.ClientSession] = None
 
-def read_pdf_text(path_or_url: str) -> str:
-    # if HTTP(S), stream to temp; else open local
+def http_session() -> aiohttp.ClientSession:
+    # created lazily because it has to be bound to the running event loop
+    global HTTP
+    if HTTP is None or HTTP.closed:
+        HTTP = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=PER_HOST),
+            # no total: a big PDF or a wait for a pooled connection isn't a stall
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=HTTP_TIMEOUT,
+                                          sock_read=HTTP_TIMEOUT))
+    return HTTP
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(CHUNK_BYTES), b""):
+            h.update(block)
+    return h.hexdigest()
+
+async def save_stream(r: aiohttp.ClientResponse) -> Tuple[str, str]:
+    """Stream a response body to a temp file, hashing on the way; (path, sha256)."""
+    h = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            async for block in r.content.iter_chunked(CHUNK_BYTES):
+                h.update(block)
+                fh.write(block)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return tmp, h.hexdigest()
+
+async def fetch_pdf(path_or_url: str) -> Tuple[str, str, bool]:
+    """(local path, sha256, is_temp); the PDF itself is never held in memory."""
+    # if HTTP(S), stream to temp; else hash local
     if path_or_url.lower().startswith("http"):
-        with requests.get(path_or_url, timeout=60) as r:
-            r.raise_for_status()
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-                tmp.write(r.content)
-                tmp_path = tmp.name
+        for attempt in range(RETRIES + 1):
+            try:
+                async with http_session().get(path_or_url) as r:
+                    if r.status not in RETRY_STATUS or attempt == RETRIES:
+                        r.raise_for_status()
+                        return (*await save_stream(r), True)
+            except aiohttp.ClientConnectionError:
+                if attempt == RETRIES:
+                    raise
+            await asyncio.sleep(0.3 * 2 ** attempt)  # connection is back in the pool meanwhile
+    return path_or_url, await asyncio.to_thread(file_sha256, path_or_url), False
+
+# PDFium is not thread-safe; parses run in worker threads, so take turns
+PDFIUM_LOCK = threading.Lock()
+
+def pdf_text(path: str) -> str:
+    # plain text layer only; no layout analysis (much faster than pdfplumber).
+    # Opened from disk, PDFium loads pages on demand instead of the whole file
+    pages = []
+    with PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(path)
         try:
-            text = ""
-            with pdfplumber.open(tmp_path) as pdf:
-                for page in pdf.pages:
-                    text += (page.extract_text() or "") + "\n"
-            return text
+            for page in pdf:
+                tp = page.get_textpage()
+                pages.append(tp.get_text_range() + "\n")
+                tp.close()
+                page.close()
         finally:
-            os.unlink(tmp_path)
-    else:
-        text = ""
-        with pdfplumber.open(path_or_url) as pdf:
-            for page in pdf.pages:
-                text += (page.extract_text() or "") + "\n"
-        return text
+            pdf.close()
+    return "".join(pages)
+
+# any whitespace run ending in a newline -> one newline (blank-line runs included)
+_NL_WS = re.compile(r"\s+\n")
 
 def chunk_text(s: str, chunk_chars: int = CHUNK_TOKENS, overlap: int = OVERLAP) -> List[str]:
-    s = re.sub(r"\s+\n", "\n", s)
-    s = re.sub(r"\n{2,}", "\n\n", s)
-    chunks = []
-    i = 0
-    while i < len(s):
-        chunk = s[i:i+chunk_chars]
-        chunks.append(chunk)
-        i += max(1, chunk_chars - overlap)
-    return [c.strip() for c in chunks if c.strip()]
-
-def embed(texts: List[str]) -> np.ndarray:
+    s = _NL_WS.sub("\n", s)
+    step = max(1, chunk_chars - overlap)
+    chunks = (s[i:i+chunk_chars].strip() for i in range(0, len(s), step))
+    return [c for c in chunks if c]
+
+async def embed(texts: List[str], batch: int = EMBED_BATCH) -> np.ndarray:
     if not texts:
         return np.zeros((0, 1536), dtype=np.float32)
-    resp = client.embeddings.create(model=EMBED_MODEL, input=texts)
-    vecs = [np.array(d.embedding, dtype=np.float32) for d in resp.data]
-    return np.vstack(vecs)
+    # one request per slice keeps big studies under the per-request limits;
+    # the semaphore keeps a big study from firing dozens at once and hitting 429s
+    async def one(i: int):
+        async with EMBED_SEM:
+            return await client.embeddings.create(model=EMBED_MODEL, input=texts[i:i+batch])
+    resps = await asyncio.gather(*(one(i) for i in range(0, len(texts), batch)))
+    out = np.empty((len(texts), len(resps[0].data[0].embedding)), dtype=np.float32)
+    row = 0
+    for resp in resps:
+        for d in resp.data:
+            out[row] = d.embedding
+            row += 1
+    return out
+
+def rank(chunk_vecs: np.ndarray, qv: np.ndarray, k: int) -> np.ndarray:
+    # cosine sim: chunk_vecs rows are unit length already, so one GEMV does it
+    qv /= np.linalg.norm(qv) + 1e-8
+    sims = chunk_vecs @ qv
+    # O(N) selection of the top k, then sort only those k
+    k = min(k, len(sims))
+    part = np.argpartition(-sims, k - 1)[:k]
+    return part[np.argsort(-sims[part])]
 
-def topk(query: str, chunks: List[str], chunk_vecs: np.ndarray, k: int = TOP_K) -> List[str]:
+def unit_rows(parts: List[np.ndarray]) -> np.ndarray:
+    # normalize once here instead of recomputing row norms on every query
+    vecs = np.concatenate(parts)
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-8
+    return vecs
+
+async def topk(query: str, chunks: List[str], chunk_vecs: np.ndarray, k: int = TOP_K) -> List[str]:
     if not chunks: return []
-    qv = embed([query])[0]
-    # cosine sim
-    denom = (np.linalg.norm(chunk_vecs, axis=1) * np.linalg.norm(qv) + 1e-8)
-    sims = (chunk_vecs @ qv) / denom
-    idx = np.argsort(-sims)[:k]
+    qv = (await embed([query]))[0]
+    # numpy work runs in a thread so other requests keep being served meanwhile
+    idx = await asyncio.to_thread(rank, chunk_vecs, qv, k)
     return [chunks[i] for i in idx]
 
-# Simple in-memory cache per NCT
-CACHE: Dict[str, Dict] = {}
+# On-disk cache per PDF, keyed by content hash + chunking/model settings,
+# so a restart never re-parses or re-embeds a document it has already seen
+DB = sqlite3.connect(CACHE_DB, check_same_thread=False)
+DB.execute("PRAGMA journal_mode=WAL")
+DB.execute("CREATE TABLE IF NOT EXISTS pdf_cache ("
+           "key TEXT PRIMARY KEY, chunks TEXT NOT NULL, dim INTEGER NOT NULL, vecs BLOB NOT NULL)")
+# ...and one vector per distinct chunk text, shared by every PDF and study,
+# so boilerplate consent language is embedded once rather than per document
+DB.execute("CREATE TABLE IF NOT EXISTS chunk_vecs (key TEXT PRIMARY KEY, vec BLOB NOT NULL)")
+
+def cache_key(sha256: str) -> str:
+    return f"{sha256}:pdfium:{EMBED_MODEL}:{CHUNK_TOKENS}:{OVERLAP}"
 
-def build_context_for_nct(nct: str) -> Dict:
-    if nct in CACHE:
-        return CACHE[nct]
+def cache_get(key: str):
+    row = DB.execute("SELECT chunks, dim, vecs FROM pdf_cache WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    chunks, dim, blob = row
+    return json.loads(chunks), np.frombuffer(blob, dtype=np.float32).reshape(-1, dim)
 
+def cache_put(key: str, chunks: List[str], vecs: np.ndarray) -> None:
+    with DB:
+        DB.execute("INSERT OR REPLACE INTO pdf_cache VALUES (?, ?, ?, ?)",
+                   (key, json.dumps(chunks, ensure_ascii=False), vecs.shape[1], vecs.tobytes()))
+
+def chunk_key(text: str) -> str:
+    return hashlib.blake2b(f"{EMBED_MODEL}\0{text}".encode("utf-8"), digest_size=16).hexdigest()
+
+def chunk_vecs_get(keys: List[str]) -> Dict[str, np.ndarray]:
+    found = {}
+    for i in range(0, len(keys), 500):  # stay under SQLite's bound-parameter limit
+        batch = keys[i:i+500]
+        q = f"SELECT key, vec FROM chunk_vecs WHERE key IN ({','.join('?' * len(batch))})"
+        for key, blob in DB.execute(q, batch):
+            found[key] = np.frombuffer(blob, dtype=np.float32)
+    return found
+
+def chunk_vecs_put(vecs: Dict[str, np.ndarray]) -> None:
+    with DB:
+        DB.executemany("INSERT OR REPLACE INTO chunk_vecs VALUES (?, ?)",
+                       ((k, v.tobytes()) for k, v in vecs.items()))
+
+async def embed_dedup(texts: List[str]) -> np.ndarray:
+    """embed() through the shared chunk store: each distinct text is sent once, ever."""
+    if not texts:
+        return await embed(texts)
+    keys = [chunk_key(t) for t in texts]
+    known = chunk_vecs_get(list(set(keys)))
+    todo = {}  # key -> text, first occurrence only
+    for k, t in zip(keys, texts):
+        if k not in known and k not in todo:
+            todo[k] = t
+    if todo:
+        fresh = dict(zip(todo, await embed(list(todo.values()))))
+        chunk_vecs_put(fresh)
+        known.update(fresh)
+    return np.stack([known[k] for k in keys])
+
+def parse_and_chunk(path: str) -> List[str]:
+    return chunk_text(pdf_text(path))
+
+async def load_source(src: str) -> Optional[list]:
+    """[src, cache key, chunks, vecs or None if not embedded yet]; None if unreadable."""
+    path, is_temp = None, False
+    try:
+        path, sha, is_temp = await fetch_pdf(src)
+        key = cache_key(sha)
+        hit = cache_get(key)
+        if hit is not None:
+            return [src, key, *hit]
+        return [src, key, await asyncio.to_thread(parse_and_chunk, path), None]
+    except Exception:
+        return None
+    finally:
+        if is_temp:
+            os.unlink(path)
+
+def context_size(ctx: Dict) -> int:
+    # vectors dominate; chunk strings counted with their object overhead
+    return ctx["vecs"].nbytes + sum(map(sys.getsizeof, ctx["chunks"]))
+
+# In-memory cache per NCT, evicted least-recently-used first once the contexts
+# add up to CACHE_MB (evicted studies reload from the SQLite cache), plus one
+# lock per NCT being built
+CACHE: LRUCache = LRUCache(maxsize=CACHE_MB * 2**20, getsizeof=context_size)
+INFLIGHT: Dict[str, asyncio.Task] = {}
+
+async def build_context_for_nct(nct: str) -> Dict:
+    ctx = CACHE.get(nct)
+    if ctx is not None:
+        return ctx
+    # singleflight: concurrent first requests for one NCT await a single build
+    # task, so they share its result (or error) even when it can't be cached
+    task = INFLIGHT.get(nct)
+    if task is None:
+        task = asyncio.ensure_future(_build_and_cache(nct))
+        INFLIGHT[nct] = task
+        task.add_done_callback(lambda t: INFLIGHT.pop(nct) if INFLIGHT.get(nct) is t else None)
+    return await asyncio.shield(task)  # one caller going away doesn't cancel the rest
+
+async def _build_and_cache(nct: str) -> Dict:
+    ctx = await load_context(nct)
+    try:
+        CACHE[nct] = ctx
+    except ValueError:
+        pass  # larger than the whole budget: serve it uncached
+    return ctx
+
+async def load_context(nct: str) -> Dict:
     # Prefer local PDFs (offline snapshot); if none, use first CSV URL(s)
     locals_ = get_local_pdfs(nct)
     sources = []
@@ -157,21 +296,25 @@ def build_context_for_nct(nct: str) -> Dict:
     else:
         sources = [u for _, u in CSV_MAP.get(nct, {}).get("docs", [])]
 
-    # Read, chunk, embed
-    all_chunks = []
-    src_map = []  # keep (source, chunk_index_in_source)
-    for src in sources[:5]:  # cap to first 5 docs per study for speed; adjust as needed
-        try:
-            txt = read_pdf_text(src)
-            chunks = chunk_text(txt)
-            start = len(all_chunks)
-            all_chunks.extend(chunks)
-            for i in range(len(chunks)):
-                src_map.append({"src": src, "i": i})
-        except Exception:
-            continue
+    # Read and chunk all sources concurrently; PDFs already in the disk cache
+    # skip parsing and embedding
+    # cap to first 5 docs per study for speed; adjust as needed
+    loaded = await asyncio.gather(*(load_source(src) for src in sources[:5]))
+    parts = [p for p in loaded if p is not None]
+
+    # one embeddings pass over every cache miss (minus chunks already seen in
+    # any other PDF), then split back per PDF
+    misses = [p for p in parts if p[3] is None]
+    new = await embed_dedup([c for p in misses for c in p[2]])
+    row = 0
+    for p in misses:
+        p[3] = new[row:row + len(p[2])]
+        row += len(p[2])
+        cache_put(p[1], p[2], p[3])
 
-    vecs = embed(all_chunks) if all_chunks else np.zeros((0,1536), dtype=np.float32)
+    all_chunks = [c for p in parts for c in p[2]]
+    src_map = [{"src": p[0], "i": i} for p in parts for i in range(len(p[2]))]  # keep (source, chunk_index_in_source)
+    vecs = await asyncio.to_thread(unit_rows, [p[3] for p in parts]) if all_chunks else np.zeros((0,1536), dtype=np.float32)
 
     meta = {
         "nct": nct,
@@ -182,11 +325,16 @@ def build_context_for_nct(nct: str) -> Dict:
         "doc_urls": [u for _, u in CSV_MAP.get(nct, {}).get("docs", [])],
     }
 
-    CACHE[nct] = {"meta": meta, "chunks": all_chunks, "vecs": vecs, "srcmap": src_map}
-    return CACHE[nct]
+    return {"meta": meta, "chunks": all_chunks, "vecs": vecs, "srcmap": src_map}
 
 # ==== API ====
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    if HTTP is not None:
+        await HTTP.close()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # tighten for prod
@@ -204,15 +352,15 @@ def health():
     return {"ok": True}
 
 @app.post("/chat")
-def chat(inp: ChatIn):
+async def chat(inp: ChatIn):
     nct = normalize_nct(inp.nct)
-    ctx = build_context_for_nct(nct)
+    ctx = await build_context_for_nct(nct)
 
     chunks = ctx["chunks"]
     if not chunks:
         return {"answer": "I couldn't load any text for this study yet (no readable PDFs). Try again or check the CSV links.", "meta": ctx["meta"]}
 
-    top = topk(inp.question, chunks, ctx["vecs"], k=TOP_K)
+    top = await topk(inp.question, chunks, ctx["vecs"], k=TOP_K)
 
     system = (
         "You answer questions about a single clinical study. "
@@ -228,6 +376,6 @@ def chat(inp: ChatIn):
         {"role": "user", "content": f"RIS metadata:\n{ris_bits}\n\nContext chunks from PDFs:\n{context_text}\n\nQuestion: {inp.question}\n\nAnswer clearly and concisely, cite page numbers if visible in the text."}
     ]
 
-    resp = client.chat.completions.create(model=CHAT_MODEL, messages=msg, temperature=0.1)
+    resp = await client.chat.completions.create(model=CHAT_MODEL, messages=msg, temperature=0.1)
     answer = resp.choices[0].message.content.strip()
     return {"answer": answer, "meta": ctx["meta"]}
@@ -0,0 +1,136 @@
+"""Shared NCT/RIS/CSV helpers for the downloaders, the site builders and the RAG server."""
+import os, re, json, pickle
+import pandas as pd
+from functools import lru_cache
+from typing import List, Tuple
+
+try:
+    import orjson
+except ImportError:  # stdlib fallback in dump_json; same data, slower encoder
+    orjson = None
+
+URL_RE = re.compile(r"(https?://[^\s,|]+?\.pdf)(?!\S)", re.I)
+_NCT_DIGITS = re.compile(r"\D")
+_UNSAFE = re.compile(r"[^a-zA-Z0-9._-]+")
+
+# the only RIS tags anyone reads; every other line is skipped undecoded
+WANTED = {b"TY", b"ID", b"AU", b"PY", b"TI"}
+# bump when parse_ris' output changes so stale <ris>.cache.pkl files are ignored
+RIS_CACHE_VERSION = 1
+
+def normalize_nct(x: str) -> str:
+    """Convert variations like 'nct4019' or 'NCT125' -> 'NCT00004019' / 'NCT00000125'."""
+    # coerce first: 1 and 1.0 hash alike but stringify differently
+    return _normalize_nct(str(x))
+
+@lru_cache(maxsize=None)
+def _normalize_nct(s: str) -> str:
+    s = s.strip().upper().replace(" ", "").replace("NCT", "")
+    s = _NCT_DIGITS.sub("", s)
+    return "NCT" + s.zfill(8)
+
+def normalize_nct_series(col: pd.Series) -> pd.Series:
+    """Vectorized normalize_nct over a whole column (one C-level pass)."""
+    digits = col.fillna("").astype(str).str.replace(r"\D", "", regex=True)
+    return "NCT" + digits.str.zfill(8)
+
+@lru_cache(maxsize=None)
+def safe(name: str, maxlen: int = 80) -> str:
+    """Clean string so it's safe for filenames."""
+    return _UNSAFE.sub("_", name.strip())[:maxlen].strip("._-")
+
+def parse_ris(path: str, cache: bool = True):
+    """
+    Stream a RIS export into {NCT: {"title", "year", "authors"}}.
+    Reads bytes and only decodes the tags in WANTED; the last value of a
+    repeated tag wins, as in the old per-record dict parser.
+    The result is pickled next to the RIS as <path>.cache.pkl and reused
+    while the file's mtime and size are unchanged.
+    """
+    if not os.path.exists(path): return {}
+    if not cache: return _parse_ris(path)
+    st = os.stat(path)
+    key = (RIS_CACHE_VERSION, st.st_mtime_ns, st.st_size)
+    cache_path = path + ".cache.pkl"
+    try:
+        with open(cache_path, "rb") as fh:
+            cached_key, meta = pickle.load(fh)
+        if cached_key == key:
+            return meta
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+        pass
+    meta = _parse_ris(path)
+    try:
+        tmp = cache_path + ".tmp"
+        with open(tmp, "wb") as fh:
+            pickle.dump((key, meta), fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_path)
+    except OSError:
+        pass  # read-only checkout: just skip the cache
+    return meta
+
+def _parse_ris(path: str):
+    meta = {}
+    rid = au = py = ti = None
+
+    def emit():
+        meta[normalize_nct(rid)] = {
+            "title": ti or "",
+            "year":  py or "",
+            "authors": [au] if au else []
+        }
+
+    with open(path, "rb") as fh:
+        for ln in fh:
+            tag = ln[:2]
+            if tag not in WANTED:
+                continue
+            if tag == b"TY":
+                # start of new record → save previous
+                if rid is not None: emit()
+                rid = au = py = ti = None
+                continue
+            val = ln[6:].decode("utf-8", "ignore").strip()
+            if tag == b"ID":   rid = val
+            elif tag == b"AU": au = val
+            elif tag == b"PY": py = val
+            else:              ti = val
+    if rid is not None: emit()
+    return meta
+
+def dump_json(obj, pretty: bool = False) -> bytes:
+    """UTF-8 JSON bytes (orjson when installed); compact unless pretty."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def extract_pairs(cell: str) -> List[Tuple[str, str]]:
+    """
+    Pull (label, url) pairs from a CSV 'Study Documents' cell.
+    Handles:
+      - "X, https://...pdf" (canonical)
+      - "X | https://...pdf"
+      - "... Prot_SAP_ICF_000.pdf" (combined)
+      - extra commas in descriptors
+    The label is the chunk text before the URL (fallback 'Document').
+    """
+    out = []
+    # empty CSV cells arrive as float NaN; skip them before any str() work
+    if cell is None or isinstance(cell, float) or str(cell).strip().lower() in ("", "nan", "none"):
+        return out
+    parts = [p.strip() for p in str(cell).split("|") if p.strip()]
+    for p in parts:
+        urls = URL_RE.findall(p)
+        if urls:
+            for u in urls:
+                label = p.split(u,1)[0].strip().strip(",")
+                out.append((label or "Document", u))
+        else:
+            # fallback: simple "label, url" split
+            if "," in p:
+                lab, rest = p.split(",",1)
+                if rest.strip().lower().startswith("http"):
+                    out.append((lab.strip() or "Document", rest.strip()))
+    return out